@@ -8,12 +8,14 @@ import fcntl
 import termios
 import sys
 import os
-from subprocess import run, PIPE, STDOUT, TimeoutExpired
+from subprocess import run, PIPE, STDOUT, DEVNULL, TimeoutExpired, CompletedProcess
 import json
 import time
 import signal
 import ctypes
-from typing import Dict, Union, List, Generator, overload, Tuple
+import functools
+from collections import ChainMap
+from typing import Dict, Union, List, Generator, overload, Tuple, Mapping
 
 RED       = u"\u001b[31m"
 GREEN     = u"\u001b[32m"
@@ -34,9 +36,20 @@ ANIMATION = forward_backward([
     u"\u28ff", u"\u28bf", u"\u28bb", u"\u28b9",
     u"\u28b8", u"\u28b0", u"\u28a0", u"\u2880"
 ])
+ANIMATION_BYTES = tuple(s.encode('utf-8') for s in ANIMATION)
 
 PR_SET_CHILD_SUBREAPER = 36
 
+# Commands simple enough to be emulated without spawning a process. Shell
+# builtins ignore PATH, executables only qualify by absolute path, as a bare
+# name may resolve to something else through the command's PATH.
+INLINE_SYSTEM = (':', 'true', 'false')
+INLINE_TRUE   = ('/bin/true', '/usr/bin/true')
+INLINE_FALSE  = ('/bin/false', '/usr/bin/false')
+INLINE_ECHO   = ('/bin/echo', '/usr/bin/echo')
+
+_PATH_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
 signals = {int(getattr(signal, m)):m for m in dir(signal) if m.startswith('SIG')}
 libc = ctypes.CDLL('libc.so.6')
 libc.prctl(PR_SET_CHILD_SUBREAPER, 1)
@@ -48,10 +61,14 @@ def is_true(val):
 
 def read_ppid(path: str) -> Union[int, None]:
     try:
-        with open(path) as f:
-            for line in f:
-                if line.startswith('PPid:'):
-                    return int(line.split('\t')[-1])
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            buf = os.read(fd, 512)
+        finally:
+            os.close(fd)
+        i = buf.find(b'\nPPid:')
+        if i >= 0:
+            return int(buf[i + 6:buf.find(b'\n', i + 1)])
     except:
         pass
 
@@ -72,10 +89,14 @@ def parent_exes():
             yield os.readlink(path)
 
 def children(parent_pid=os.getpid()):
-    for entry in os.listdir('/proc'):
-        ppid = read_ppid(f'/proc/{entry}/status')
-        if ppid == parent_pid:
-            yield int(entry)
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name[0].isdigit() and entry.is_dir(follow_symlinks=False)):
+                continue
+            ppid = read_ppid(f'/proc/{name}/status')
+            if ppid == parent_pid:
+                yield int(name)
 
 def dict_concat(*dicts: Union[Dict[str,str], os._Environ, None]) -> Dict[str,str]:
     res = {}
@@ -85,20 +106,141 @@ def dict_concat(*dicts: Union[Dict[str,str], os._Environ, None]) -> Dict[str,str
                 res[key] = val
     return res
 
+class _ExpandedDict(dict):
+    # Expands the values of d on first lookup, so they may refer to each
+    # other in any order. While a value is being expanded its own name
+    # resolves to environ.
+    def __init__(self, d: Dict[str,str], environ):
+        super().__init__()
+        self._raw = d
+        self._busy = set()
+        self.lookup = ChainMap(self, environ)
+
+    def __contains__(self, key):
+        return key in self._raw and key not in self._busy
+
+    def __missing__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._busy.add(key)
+        try:
+            val = self[key] = normalize(self._raw[key], self.lookup)
+        finally:
+            self._busy.discard(key)
+        return val
+
 def normalize_dict(d: Dict[str,str], environ=os.environ) -> Union[Dict[str,str],None]:
     if d:
-        c = dict_concat(d, environ)
-        res = {}
-        for key, val in d.items():
-            res[key] = normalize(val, c)
-        return res
+        res = _ExpandedDict(d, environ)
+        return {key: res[key] for key in d}
+
+_IS_TTY = sys.stdout.isatty()
+_TERM_H = [25]
+_TERM_W = [80]
+
+def _refresh_term_size(*_):
+    if _IS_TTY:
+        _TERM_H[0], _TERM_W[0] = struct.unpack('hh', fcntl.ioctl(0, termios.TIOCGWINSZ, b'1234'))
+
+_refresh_term_size()
+signal.signal(signal.SIGWINCH, _refresh_term_size)
 
 def get_terminal_size() -> Tuple[int,int]:
-    if sys.stdout.isatty():
-        res = struct.unpack('hh', fcntl.ioctl(0, termios.TIOCGWINSZ, b'1234'))
-        return (res[0], res[1])
+    return (_TERM_H[0], _TERM_W[0])
+
+def _run_bash(cmd: str, env=None, cwd=None) -> Tuple[int, bytes]:
+    if cwd is not None:
+        # posix_spawn() cannot change directory
+        p = run(['/bin/bash', '-c', cmd], stdout=PIPE, stderr=STDOUT, cwd=cwd, env=env)
+        return (p.returncode, p.stdout)
+
+    r, w = os.pipe2(os.O_CLOEXEC)
+    try:
+        try:
+            pid = os.posix_spawn('/bin/bash', ['/bin/bash', '-c', cmd], os.environ if env is None else env,
+                                 file_actions=[(os.POSIX_SPAWN_DUP2, w, 1), (os.POSIX_SPAWN_DUP2, w, 2)],
+                                 setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        finally:
+            os.close(w)
+        chunks = []
+        while True:
+            chunk = os.read(r, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(r)
+    _, status = os.waitpid(pid, 0)
+    return (os.waitstatus_to_exitcode(status), b''.join(chunks))
+
+_BRACKETS = {'{': '}', '(': ')'}
+
+def _find_closing(s: str, start: int, open_token: str) -> Union[int, None]:
+    close_token = _BRACKETS[open_token]
+    count = 1
+    for i in range(start, len(s)):
+        if s[i] == '$' and s[i + 1:i + 2] == open_token:
+            count += 1
+        elif s[i] == close_token:
+            count -= 1
+            if count == 0:
+                return i
+
+def _substitute(open_token: str, n: str, environ) -> str:
+    if open_token == '{':
+        parts = n.split('|')
+        n = parts[0]
+        filter_names = parts[1:]
+
+        parts = n.split(':')
+        n = parts[0]
+        parts = parts[1:]
+        default_value = None
+
+        if parts and parts[0] and parts[0][0] == '-':
+            default_value = parts[0][1:]
+
+        if n in environ:
+            n = environ[n]
+        elif default_value is not None:
+            n = default_value
+        else:
+            raise Exception(f"Unresolved environment variable: {n}")
+
+        for filter_name in filter_names:
+            try:
+                f = getattr(str, filter_name)
+                n = f(n)
+            except:
+                raise Exception(f'No such filter: {filter_name}')
     else:
-        return (25, 80)
+        returncode, output = _run_bash(n)
+        if returncode != 0:
+            raise Exception(f"Could not execute command: {n}")
+        n = output.decode('utf8')
+    return n
+
+def _expand(s: str, environ) -> List[str]:
+    out = []
+    start = 0
+    i = s.find('$')
+    while i >= 0:
+        open_token = s[i + 1:i + 2]
+        if open_token not in _BRACKETS:
+            i = s.find('$', i + 1)
+            continue
+        end = _find_closing(s, i + 2, open_token)
+        if end is None:
+            raise Exception('Missing closing bracket')
+        inner = s[i + 2:end]
+        if '$' in inner:
+            inner = ''.join(_expand(inner, environ))
+        out.append(s[start:i])
+        out.append(_substitute(open_token, inner, environ))
+        start = end + 1
+        i = s.find('$', start)
+    out.append(s[start:])
+    return out
 
 @overload
 def normalize(s: str, environ=os.environ) -> str: ...
@@ -114,89 +256,44 @@ def normalize(s: int, environ=os.environ) -> int: ...
 def normalize(s: Union[str,int,None,list,dict], environ=os.environ) -> Union[str,int,None,list,dict]:
     if s is None:
         return s
-    elif type(s) in (int, bool):
+    elif isinstance(s, int): # bool is a subclass of int
         return s
     elif isinstance(s, list):
         return [normalize(e, environ) for e in s]
     elif isinstance(s, dict):
         return {k:normalize(v, environ) for k, v in s.items()}
-
-    pairs = [
-        ['{','}'],
-        ['(',')']
-    ]
-    def findMatching(s, idx):
-        openToken = s[idx + 1]
-        tokenPair = next(iter(filter(lambda e: e[0] == openToken, pairs)), None)
-        if tokenPair is not None:
-            closeToken = tokenPair[1]
-            count = 1
-            for i in range(idx + 1, len(s)):
-                if s[i] == '$' and s[i + 1] == openToken:
-                    count += 1
-                elif s[i] == closeToken:
-                    count -= 1
-                if count == 0:
-                    return i
-
-    formatted = '|'.join('\\' + p[0] for p in pairs)
-    regex = f"\\$({formatted})"
-
-    if isinstance(s, str):
-        while True:
-            m = re.search(regex, str(s))
-            if not m:
-                return s
-            idx1 = m.span()[0]
-            idx2 = findMatching(s, idx1)
-            if idx2 is None:
-                raise Exception('Missing closing bracket')
-            n = normalize(str(s)[idx1 + 2:idx2], environ)
-            if str(s)[idx1 + 1] == '{':
-                parts = n.split('|')
-                n = parts[0]
-                filter_names = parts[1:]
-
-                parts = n.split(':')
-                n = parts[0]
-                parts = parts[1:]
-                default_value = None
-
-                if parts and parts[0] and parts[0][0] == '-':
-                    default_value = parts[0][1:]
-
-                if n in environ:
-                    n = environ[n]
-                elif default_value is not None:
-                    n = default_value
-                else:
-                    raise Exception(f"Unresolved environment variable: {n}")
-
-                for filter_name in filter_names:
-                    try:
-                        f = getattr(str, filter_name)
-                        n = f(n)
-                    except:
-                        raise Exception(f'No such filter: {filter_name}')
-
-            elif str(s)[idx1 + 1] == '(':
-                proc = run(['/bin/bash', '-c', n], stdout=PIPE, stderr=STDOUT)
-                if proc.returncode != 0:
-                    raise Exception(f"Could not execute command: {n}")
-                n = proc.stdout.decode('utf8')
-            s = str(s)[:idx1] + n + str(s)[idx2 + 1:]
+    elif isinstance(s, str):
+        if '$' not in s:
+            return s
+        return ''.join(_expand(s, environ))
 
 def be_str(func):
     def w(self, t=None, count=True):
         if not t is None:
-            if not type(t) in (bytes, str):
+            if not isinstance(t, (bytes, str)):
                 t = str(t)
         return func(self, t, count)
     return w
 
+_SGR_RUN_RE = re.compile(rb'(?:\x01\x1b\[[0-9;]*m\x02){2,}')
+_SGR_RE = re.compile(rb'\x1b\[([0-9;]*)m')
+
+def _merge_sgr(m) -> bytes:
+    params: List[bytes] = []
+    for p in _SGR_RE.findall(m.group(0)):
+        if p in (b'', b'0'):
+            params = [b'0']
+        elif not params or params[-1] != p:
+            params.append(p)
+    return b'\x01\x1b[' + b';'.join(params) + b'm\x02'
+
+def _coalesce_sgr(buf: bytes) -> bytes:
+    return _SGR_RUN_RE.sub(_merge_sgr, buf)
+
 class Writer(object):
     def __init__(self, out):
-        self.out = out
+        self.out = out.buffer
+        self._buf = bytearray()
         self.indentation = 0
         self.clean = True
         self.pos = 0
@@ -209,11 +306,9 @@ class Writer(object):
     @be_str
     def __call__(self, t, count=True):
         if count:
-            w = get_terminal_size()[1]
-            l = w - self.pos
+            l = _TERM_W[0] - self.pos
             t = t[:l]
-        self.out.write(t)
-        self.out.flush()
+        self._buf += t.encode('utf-8') if isinstance(t, str) else t
         self.clean = False
         if count:
             self.pos += len(t)
@@ -230,14 +325,29 @@ class Writer(object):
     @be_str
     def blue(self, t, count=True):
         return self.ansi(BLUE)(t, count).ansi(RESET)
+    def flush(self):
+        if self._buf:
+            # Take the bytes out before writing, a signal handler may flush in between
+            data = _coalesce_sgr(self._buf)
+            self._buf.clear()
+            self.out.write(data)
+            self.out.flush()
+        return self
+    def raw(self, data: bytes):
+        self.flush()
+        self.out.write(data)
+        self.out.flush()
+        self.clean = False
+        return self
     def begin(self):
+        self.flush()
         self.pos = 0
         return self.ansi('\r')(' ' * self.indentation).ansi(ERASE_EOL)
     def end(self, t=None, count=True, newline=True):
         self((t or ''), count)('\n' if newline else '', False)
         self.clean = True
         self.pos = 0
-        return self
+        return self.flush()
 
 class Terminal(object):
     def __init__(self):
@@ -249,8 +359,8 @@ class Terminal(object):
         self._stderr.increment()
 
     def __exit__(self, t, v, tr):
-        if not (self._stdout.clean and self._stdout.clean):
-            (self._stdout if self._stdout.clean else self._stdout).end()
+        if not (self._stdout.clean and self._stderr.clean):
+            (self._stderr if self._stdout.clean else self._stdout).end()
         self._stdout.decrement()
         self._stderr.decrement()
 
@@ -266,6 +376,11 @@ class Terminal(object):
     def restore_pos(self):
         self._stdout.ansi('\033[u')
 
+    def animate(self, c: 'Command'):
+        w = self._stdout
+        budget = _TERM_W[0] - w.indentation - 6
+        w.raw(b'\x01\r\x02' + b' ' * w.indentation + _ANIMATION_HEAD + c._animation_frame() + c._animation_tail(budget))
+
     @property
     def stdout(self):
         return self._stdout.begin()
@@ -274,6 +389,8 @@ class Terminal(object):
     def stderr(self):
         return self._stderr.begin()
 
+_ANIMATION_HEAD = f"\x01{ERASE_EOL}\x02\r    \x01{YELLOW}\x02".encode('utf-8')
+
 term = Terminal()
 
 class Command(object):
@@ -285,15 +402,18 @@ class Command(object):
     STATE_SKIPPED = 5
     STATE_EXECUTING = 6
 
-    def __init__(self, conf, group, settings):
+    def __init__(self, conf, group, settings, runtime_env=()):
         if not 'name' in conf:
             raise Exception('Command missing "name"')
         if not ('exec' in conf or 'system' in conf):
             raise Exception('Command missing "exec" or "system"')
         self._animation_idx = 0
+        self._animation_line = None
         self.group = group
         self.state = Command.STATE_NEW
         self.output = None
+        self._strout = None
+        self._cmd_parts = None
         self.duration = None
 
         self._conf = conf
@@ -303,11 +423,26 @@ class Command(object):
         self._execute = None
         self._skipped = None
 
+        # The configuration is expanded once, when the command is executed.
+        # Until then env and name are computed on demand.
+        self._runtime_env = runtime_env
+        self._env = None
+        self._name = None
+        self.path = None
+        self.args = None
+        self._setting_attrs = set()
+        self._apply_settings()
+
     def __getattr__(self, name):
-        if 'settings' in self._conf and name in self._conf['settings']:
-            return self._conf['settings'][name]
-        elif name in self._settings:
-            return self._settings[name]
+        # Settings that are not configured anywhere
+        return None
+
+    def _apply_settings(self):
+        for key, val in dict_concat(self._settings, self._conf.get('settings')).items():
+            attr = key.replace('-', '_')
+            if attr in self._setting_attrs or not (attr in self.__dict__ or hasattr(Command, attr)):
+                self._setting_attrs.add(attr)
+                setattr(self, attr, val)
 
     @property
     def is_disabled(self):
@@ -343,33 +478,90 @@ class Command(object):
 
     def _output(self, o):
         self.output = o
+        self._strout = None
+
+    @functools.cached_property
+    def command_str(self) -> Union[str, None]:
+        if self._cmd_parts is not None:
+            return ' '.join(shlex.quote(s) for s in self._cmd_parts)
 
     @property
     def strout(self) -> str:
-        if isinstance(self.output, str):
-            return self.output
-
-        try:
-            return self.output.decode('utf-8') if self.output is not None else '<<< NO OUTPUT SET >>>'
-        except:
-            return '<<< OUTPUT NOT UTF-8 >>>'
+        if self._strout is None:
+            if isinstance(self.output, str):
+                self._strout = self.output
+            else:
+                try:
+                    self._strout = self.output.decode('utf-8') if self.output is not None else '<<< NO OUTPUT SET >>>'
+                except:
+                    self._strout = '<<< OUTPUT NOT UTF-8 >>>'
+        return self._strout
 
 
     @property
     def env(self):
-        return dict_concat(os.environ, normalize_dict(self._conf.get('environment')))
+        if self._env is None:
+            return ChainMap(normalize_dict(self._conf.get('environment')) or {}, os.environ)
+        return self._env
 
     @property
     def name(self):
-        return normalize(self._conf['name'], self.env)
-
-    @property
-    def path(self):
-        return normalize(self._conf['exec'], self.env) if 'exec' in self._conf else self.env.get('SHELL', '/bin/sh')
-
-    @property
-    def args(self):
-        return ([normalize(a, self.env) for a in self._conf['arguments']] if 'arguments' in self._conf else []) if 'exec' in self._conf else ['-c', self._conf['system']]
+        if self._name is not None:
+            return self._name
+        try:
+            name = normalize(self._conf['name'], self.env)
+        except Exception:
+            # Expansion errors are reported when the command runs, show the raw name until then
+            return self._conf['name']
+        if self._is_static(self._conf['name']) and self._is_static(self._conf.get('environment')):
+            self._name = name
+        return name
+
+    def _is_static(self, val) -> bool:
+        if isinstance(val, list):
+            return all(self._is_static(v) for v in val)
+        elif isinstance(val, dict):
+            return all(self._is_static(v) for v in val.values())
+        elif not isinstance(val, str) or '$' not in val:
+            return True
+        return '$(' not in val and not any(n in val for n in self._runtime_env)
+
+    def _resolve(self) -> Mapping[str,str]:
+        conf = self._conf
+        env = ChainMap(normalize_dict(conf.get('environment')) or {}, os.environ)
+        for key, val in conf.items():
+            if key != 'environment':
+                conf[key] = normalize(val, env)
+
+        self._name = conf['name']
+        self.path = conf['exec'] if 'exec' in conf else env.get('SHELL', '/bin/sh')
+        self.args = (conf['arguments'] if 'arguments' in conf else []) if 'exec' in conf else ['-c', conf['system']]
+        return env
+
+    def _run_inline(self) -> Union[CompletedProcess, None]:
+        if self.chdir is not None:
+            return None
+        cmd = self._cmd_parts
+        if 'system' in self._conf:
+            system = self._conf['system'].strip()
+            if system in INLINE_SYSTEM:
+                return CompletedProcess(cmd, 1 if system == 'false' else 0, b'')
+        elif self.path in INLINE_TRUE:
+            return CompletedProcess(cmd, 0, b'')
+        elif self.path in INLINE_FALSE:
+            return CompletedProcess(cmd, 1, b'')
+        elif self.path in INLINE_ECHO and 'POSIXLY_CORRECT' not in self.env:
+            # Only plain arguments with optional leading -n, anything that
+            # echo could take for an option is left to the real thing.
+            args = self.args
+            newline = True
+            while args and args[0] == '-n':
+                newline = False
+                args = args[1:]
+            if args and (args[0] in ('--help', '--version') or \
+                         (len(args[0]) > 1 and args[0][0] == '-' and all(c in 'neE' for c in args[0][1:]))):
+                return None
+            return CompletedProcess(cmd, 0, os.fsencode(' '.join(args) + ('\n' if newline else '')))
 
     def _fail(self, n=None):
         if self._failure:
@@ -391,51 +583,53 @@ class Command(object):
                 self._skipped(self)
             return self
 
-        self.state = Command.STATE_EXECUTING
         pre = time.time()
 
-        for key, val in self._conf.items():
-            self._conf[key] = normalize(val, self.env)
-
         try:
             try:
+                self._env = self._resolve()
+                self._apply_settings()
+                # Only now may the animation pick the command up, it needs path and args
+                self.state = Command.STATE_EXECUTING
                 if self._execute:
                     self._execute(self)
-                self.command_str = ' '.join(shlex.quote(s) for s in ([self.path] + self.args))
-                proc = run([self.path] + self.args, stdout=PIPE, stderr=STDOUT, timeout=self.timeout, cwd=normalize(self.chdir, self.env), env=self.env)
+                self._cmd_parts = [self.path] + self.args
+                stderr = STDOUT if is_true(self.capture_stderr) else DEVNULL
+                proc = self._run_inline() or run(self._cmd_parts, stdout=PIPE, stderr=stderr, timeout=self.timeout, cwd=normalize(self.chdir, self.env), env=self.env)
             finally:
                 self.duration = time.time() - pre
 
             self._output(proc.stdout)
+            out = self.strout
 
             for i in ('output-matches', '!output-matches'):
                 if i in self._conf and isinstance(self._conf[i], list):
                     self._conf[i] = '\n'.join(self._conf[i])
 
-            if proc.returncode == self.__getattr__('expected-exit-code'):
+            if proc.returncode == self.expected_exit_code:
                 if 'output-matches' in self._conf:
-                    if self._conf['output-matches'] != self.strout:
+                    if self._conf['output-matches'] != out:
                         self.state = Command.STATE_FAILED
                         return self._fail()
                 if 'output-contains' in self._conf:
                     m = self._conf['output-contains']
-                    if type(m) == str:
+                    if isinstance(m, str):
                         m = [m]
-                    if not all(self.strout.find(s) >= 0 for s in m):
+                    if not all(s in out for s in m):
                         self.state = Command.STATE_FAILED
                         return self._fail()
                 if '!output-contains' in self._conf:
                     m = self._conf['!output-contains']
-                    if type(m) == str:
+                    if isinstance(m, str):
                         m = [m]
-                    if not all(self.strout.find(s) < 0 for s in m):
+                    if any(s in out for s in m):
                         self.state = Command.STATE_FAILED
                         return self._fail()
                 if 'success-command' in self._conf:
                     cmd = self._conf['success-command']
-                    p = run(['/bin/bash', '-c', cmd], stdout=PIPE, stderr=STDOUT, cwd=normalize(self.chdir, self.env), env=self.env)
-                    if p.returncode != 0:
-                        n = p.stdout.decode('utf8')
+                    returncode, output = _run_bash(cmd, self.env, normalize(self.chdir, self.env))
+                    if returncode != 0:
+                        n = output.decode('utf8')
                         self.state = Command.STATE_FAILED
                         return self._fail(n if n else 'Success checking command failed')
                 self.state = Command.STATE_SUCCESSFUL
@@ -459,6 +653,20 @@ class Command(object):
         self._animation_idx = (self._animation_idx + 1) % len(ANIMATION)
         return s
 
+    def _animation_frame(self) -> bytes:
+        b = ANIMATION_BYTES[self._animation_idx]
+        self._animation_idx = (self._animation_idx + 1) % len(ANIMATION_BYTES)
+        return b
+
+    def _animation_tail(self, budget: int) -> bytes:
+        if self._animation_line is None or self._animation_line[0] != budget:
+            name = (' ' + self.name)[:max(budget, 0)]
+            sep = ': '[:max(budget - len(name), 0)]
+            cmd = ' '.join([e.replace('\n', '') for e in [self.path] + self.args])[:max(budget - len(name) - len(sep), 0)]
+            tail = f"{name}\x01{RESET}\x02{sep}\x01{BLUE}\x02{cmd}\x01{RESET}\x02"
+            self._animation_line = (budget, _coalesce_sgr(tail.encode('utf-8')))
+        return self._animation_line[1]
+
     def _sign(self):
         return (HOURGLASS if self.state == Command.STATE_NEW else \
                 SUCCESS if self.state == Command.STATE_SUCCESSFUL else \
@@ -468,6 +676,22 @@ class Command(object):
     def __str__(self):
         return self._sign() + ' ' + self.name
 
+_STATUS_STR = {
+    Command.STATE_SUCCESSFUL: b"Successful",
+    Command.STATE_FAILED:     b"Failed",
+    Command.STATE_TIMED_OUT:  b"Timed out",
+    Command.STATE_SKIPPED:    b"Skipped"
+}
+
+def _dump(path: str, data: bytes):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
 def resolve_includes(conf, conf_path):
     def inc_path(inc, p):
         path = os.path.join(os.path.dirname(conf_path), p)
@@ -487,7 +711,7 @@ def resolve_includes(conf, conf_path):
         if not 'include' in inc:
             raise Exception('Missing include')
 
-        if type(inc['include']) == list:
+        if isinstance(inc['include'], list):
             res = []
             for i in [inc_path(inc, p) for p in inc['include']]:
                 res += i
@@ -497,7 +721,7 @@ def resolve_includes(conf, conf_path):
 
     if 'command_groups' in conf:
         for group_name, group_value in conf['command_groups'].items():
-            if type(group_value) == dict:
+            if isinstance(group_value, dict):
                 group_value = include(group_value)
 
             while True:
@@ -557,7 +781,8 @@ class Bugger(object):
            'exit-on-fail': False,
            'expected-exit-code': 0,
            'animation': True,
-           'enable-collapse': True
+           'enable-collapse': True,
+           'capture-stderr': True
         }
 
         if not 'command_groups' in conf:
@@ -571,7 +796,7 @@ class Bugger(object):
                 try:
                     os.environ[k] = normalize(v)
                 except Exception as e:
-                    term.stderr.red('Error normalizing environment variable "').blue(k).red('"="').blue(v).red('" : ').blue(str(e))
+                    term.stderr.red('Error normalizing environment variable "').blue(k).red('"="').blue(v).red('" : ').blue(str(e)).flush()
 
         # Update default settings
         if 'settings' in conf:
@@ -597,14 +822,16 @@ class Bugger(object):
             yield g
 
     def _create_commands(self):
+        runtime_env = {t['stdout-to-env'] for ts in self._conf['command_groups'].values() for t in ts \
+                       if isinstance(t.get('stdout-to-env'), str)}
         for group_name in self._conf['command_groups'].keys():
             group = CommandGroup(normalize(group_name), self)
             if not group.is_disabled:
                 self.groups.append(group)
                 with term:
                     for t in self._conf['command_groups'][group_name]:
-                        c = Command(t, group.name, self._settings) \
-                        .on_execute(lambda c: term.stdout.yellow(str(c))(': ').blue(' '.join([e.replace('\n', '') for e in [c.path] + c.args]))) \
+                        c = Command(t, group.name, self._settings, runtime_env) \
+                        .on_execute(lambda c: term.stdout.yellow(str(c))(': ').blue(' '.join([e.replace('\n', '') for e in [c.path] + c.args])).flush()) \
                         .on_success(lambda c: term.stdout.green(str(c))(f" ({c.duration or 0.0:.3f} secs): ").blue(c.strout.split('\n')[0]).end())  \
                         .on_failure(lambda c, e: term.stdout.red(str(c))(f" ({c.duration:.3f} secs): ").blue(e.split('\n')[0]).end()) \
                         .on_skipped(lambda c: term.stdout(str(c))(': SKIPPED!').end())
@@ -620,42 +847,28 @@ class Bugger(object):
     def _animate(self, signum: int, stack_frame):
         c = next(iter([c for c in self.commands if c.state == Command.STATE_EXECUTING]), None)
         if c:
-            term.stdout(f'\r    ').yellow(str(c))(': ').blue(' '.join([e.replace('\n', '') for e in [c.path] + c.args]))
+            term.animate(c)
 
     def _save(self, path):
-        def ensure(p):
-            if not os.path.exists(p):
-                ensure(os.path.dirname(p))
-                os.mkdir(p)
+        def unbadify(s):
+            return ''.join(c if c in _PATH_SAFE_CHARS else '_' for c in s)
 
         if path:
             for group in self.groups:
                 for command in group.commands:
-                    good = string.ascii_letters + string.digits + '_'
-                    def unbadify(s):
-                        return ''.join(c if c in good else '_' for c in s)
                     cmd_path = os.path.realpath(os.path.join(path, unbadify(group.name), unbadify(command.name)))
-                    ensure(cmd_path)
+                    os.makedirs(cmd_path, exist_ok=True)
                     if command.command_str is not None:
-                        with open(os.path.join(cmd_path, 'command'), 'w') as f:
-                            f.write(command.command_str)
+                        _dump(os.path.join(cmd_path, 'command'), command.command_str.encode('utf-8'))
                     if command.output is not None:
-                        with open(os.path.join(cmd_path, 'output'), 'wb') as f:
-                            f.write(command.output)
-                    with open(os.path.join(cmd_path, 'status'), 'w') as f:
-                        if command.state == Command.STATE_SUCCESSFUL:
-                            f.write("Successful")
-                        elif command.state == Command.STATE_SIGNALED:
-                            f.write(f"Terminated by signal {signals.get(command.signal, str(command.signal))}")
-                        elif command.state == Command.STATE_FAILED:
-                            f.write("Failed")
-                        elif command.state == Command.STATE_TIMED_OUT:
-                            f.write("Timed out")
-                        elif command.state == Command.STATE_SKIPPED:
-                            f.write("Skipped")
+                        _dump(os.path.join(cmd_path, 'output'), command.output)
+                    if command.state == Command.STATE_SIGNALED:
+                        status = f"Terminated by signal {signals.get(command.signal, str(command.signal))}".encode('utf-8')
+                    else:
+                        status = _STATUS_STR.get(command.state, b'')
+                    _dump(os.path.join(cmd_path, 'status'), status)
                     if 'output-matches' in command._conf:
-                        with open(os.path.join(cmd_path, 'output-matches'), 'w') as f:
-                            f.write(command._conf['output-matches'])
+                        _dump(os.path.join(cmd_path, 'output-matches'), command._conf['output-matches'].encode('utf-8'))
 
     @property
     def current_group(self) -> Union[CommandGroup, None]:
@@ -706,7 +919,7 @@ class Bugger(object):
                     if skip:
                         c.skip()
                     c()
-                    if c.__getattr__('exit-on-fail') and c.state != Command.STATE_SUCCESSFUL:
+                    if c.exit_on_fail and c.state != Command.STATE_SUCCESSFUL:
                         skip = True
         if self.should_collapse:
             self._print_collapsed_run()
@@ -733,7 +946,7 @@ class Bugger(object):
         if 'save-output' in self._settings and self._settings['save-output']:
             self._save(normalize(self._settings['save-output']))
 
-    @property
+    @functools.cached_property
     def have_trailing_newline(self):
         for p in parent_exes():
             if os.path.basename(p) in ('entr', 'watch'):
@@ -743,15 +956,19 @@ class Bugger(object):
     def _reap_children(self):
         my_pid = os.getpid()
         while True:
-            children_pids = [c for c in children(my_pid)]
-            if not children_pids:
-                return
-            for child in children_pids:
+            for child in children(my_pid):
                 try:
                     os.kill(child, signal.SIGKILL)
-                    os.waitpid(child, os.WSTOPPED)
                 except:
                     pass
+            try:
+                pid, _ = os.waitpid(-1, 0)
+                # Reap whatever else already died. Anything still alive has
+                # been reparented to us since the scan and needs killing.
+                while pid:
+                    pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
 
     @property
     def animation_enabled(self):
@@ -772,7 +989,7 @@ class Bugger(object):
 
 def main(test_config_path='./bugger.json', *enabled):
     if not os.path.isfile(test_config_path):
-        term.stderr.blue(test_config_path).red(' is missing or not a file\n')
+        term.stderr.blue(test_config_path).red(' is missing or not a file\n').flush()
     else:
         try:
             with open(test_config_path) as f:
@@ -783,9 +1000,9 @@ def main(test_config_path='./bugger.json', *enabled):
                             g.disable()
                 return r()
         except PermissionError:
-            term.stderr.red('Could not open ').blue(test_config_path).red(' for reading')
+            term.stderr.red('Could not open ').blue(test_config_path).red(' for reading').flush()
         except json.decoder.JSONDecodeError:
-            term.stderr.blue(test_config_path).red(' is not valid JSON')
+            term.stderr.blue(test_config_path).red(' is not valid JSON').flush()
     return 1
 
 if __name__ == '__main__':